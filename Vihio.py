@@ -1,7 +1,20 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import heapq
+import http.server
 import json
+import multiprocessing
+import os
 import random
+import threading
 import time
 import logging
+import urllib.parse
+import zlib
 
 import paho.mqtt.client as mqtt
 import requests
@@ -53,6 +66,12 @@ class Device:
         9: "Stand-By"
     }
     is_heating_statuses = [2, 3, 4, 5, 502, 503, 504, 51, 6, 7]
+    deadband_settings = {
+        "temp": "temperature_deadband",
+        "exit_temp": "temperature_deadband",
+        "fumes_temp": "temperature_deadband",
+        "pellet_qty": "pellet_quantity_deadband"
+    }
 
     def __init__(self, house, device_id, name, hostname):
         self.house = house
@@ -69,6 +88,14 @@ class Device:
         self.fumes_temp_sensor_mqtt_config = None
         self.pellet_qty_sensor_discovery_topic = None
         self.pellet_qty_sensor_mqtt_config = None
+        self.burn_rate_sensor_discovery_topic = None
+        self.burn_rate_sensor_mqtt_config = None
+        self.time_to_empty_sensor_discovery_topic = None
+        self.time_to_empty_sensor_mqtt_config = None
+        self.duty_cycle_sensor_discovery_topic = None
+        self.duty_cycle_sensor_mqtt_config = None
+        self.last_refill_sensor_discovery_topic = None
+        self.last_refill_sensor_mqtt_config = None
         self.target_temperature = None
         self.room_temperature = None
         self.exit_temperature = None
@@ -77,56 +104,48 @@ class Device:
         self.status = None
         self.mode = None
         self.topic_to_func = None
-        self.availability = "offline"
+        # Unknown until the box answers or fails to, what a previous run retained is not trusted either way
+        self.availability = None
         self.last_update = 0
-
-    def __str__(self):
-        return json.dumps({
-            'name': self.name,
-            'hostname': self.hostname,
-            'climate_discovery_topic': self.climate_discovery_topic,
-            'climate_mqtt_config': self.climate_mqtt_config,
-            'status_sensor_discovery_topic': self.status_sensor_discovery_topic,
-            'status_sensor_mqtt_config': self.status_sensor_mqtt_config,
-            'exit_temp_sensor_discovery_topic': self.exit_temp_sensor_discovery_topic,
-            'exit_temp_sensor_mqtt_config': self.exit_temp_sensor_mqtt_config,
-            'fumes_temp_sensor_discovery_topic': self.fumes_temp_sensor_discovery_topic,
-            'fumes_temp_sensor_mqtt_config': self.fumes_temp_sensor_mqtt_config,
-            'pellet_qty_sensor_discovery_topic': self.pellet_qty_sensor_discovery_topic,
-            'pellet_qty_sensor_mqtt_config': self.pellet_qty_sensor_mqtt_config,
-            'target_temperature': self.target_temperature,
-            'room_temperature': self.room_temperature,
-            'exit_temperature': self.exit_temperature,
-            'fumes_temperature': self.fumes_temperature,
-            'pellet_quantity': self.pellet_quantity,
-            'status': self.status,
-            'mode': self.mode
-        })
+        self.published_values = {}
+        self.last_full_publish = 0
+        self.commands = CommandQueue(house.command_executor, self.on_command_success)
+        self.status_code = None
+        self.last_data = None
+        self.history = History(house.config.history_size, house.config.history_bucket_seconds,
+                               house.config.history_buckets)
+        self.pellets = PelletStatistics(house.config.derived_sensors_window)
 
     def update_state(self, data):
+        self.restore_state(data)
+        self.availability = "online"
+        self.last_update = time.time()
+        self.history.add(self.last_update, [self.room_temperature, self.exit_temperature, self.fumes_temperature,
+                                            self.target_temperature, self.pellet_quantity, self.status_code])
+        self.pellets.add(self.last_update, self.pellet_quantity, self.mode == "heat")
+
+    def restore_state(self, data):
+        self.last_data = data
         self.target_temperature = data["SETP"]
         self.room_temperature = data["T1"]
         self.exit_temperature = data["T2"]
         self.fumes_temperature = data["T3"]
         self.pellet_quantity = float(data["PQT"])
+        self.status_code = data["LSTATUS"]
         self.status = self.status_names.get(data["LSTATUS"], "Off")
         self.mode = "heat" if data["LSTATUS"] in self.is_heating_statuses else "off"
-        if time.time() - self.last_update < self.house.config.offline_timeout:
-            self.availability = "online"
-        else:
-            self.availability = "offline"
-        self.last_update = time.time()
 
     def update_mqtt_config(self):
+        self.published_values = {}
         self.climate_discovery_topic = self.house.config.mqtt_discovery_prefix + "/climate/" + self.device_id + "/config"
         self.climate_mqtt_config = {
             "name": self.name,
             "unique_id": self.device_id,
 
-            "current_temperature_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/temp",
-            "mode_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/mode",
-            "temperature_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/target_temp",
-            "availability_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/availability",
+            "current_temperature_topic": self.state_topic("temp"),
+            "mode_state_topic": self.state_topic("mode"),
+            "temperature_state_topic": self.state_topic("target_temp"),
+            "availability_topic": self.state_topic("availability"),
 
             "mode_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/mode",
             "temperature_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/target_temp",
@@ -141,99 +160,180 @@ class Device:
         self.status_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_status/config"
         self.status_sensor_mqtt_config = {
             "name": self.name + " (status)",
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/status"
+            "state_topic": self.state_topic("status")
         }
         self.exit_temp_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_exit_temp/config"
         self.exit_temp_sensor_mqtt_config = {
             "name": self.name + " (exit temperature)",
             "device_class": "temperature",
             "unit_of_measurement": self.house.config.temperature_unit,
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/exit_temp"
+            "state_topic": self.state_topic("exit_temp")
         }
         self.fumes_temp_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_fumes_temp/config"
         self.fumes_temp_sensor_mqtt_config = {
             "name": self.name + " (fumes temperature)",
             "device_class": "temperature",
             "unit_of_measurement": self.house.config.temperature_unit,
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/fumes_temp"
+            "state_topic": self.state_topic("fumes_temp")
         }
         self.pellet_qty_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_pellet_qty/config"
         self.pellet_qty_sensor_mqtt_config = {
             "name": self.name + " (pellet quantity)",
             "unit_of_measurement": self.house.config.pellet_quantity_unit,
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/pellet_qty"
+            "state_topic": self.state_topic("pellet_qty")
+        }
+        self.burn_rate_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_burn_rate/config"
+        self.burn_rate_sensor_mqtt_config = {
+            "name": self.name + " (pellet burn rate)",
+            "unit_of_measurement": self.house.config.pellet_quantity_unit + "/h",
+            "state_topic": self.state_topic("burn_rate")
+        }
+        self.time_to_empty_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_time_to_empty/config"
+        self.time_to_empty_sensor_mqtt_config = {
+            "name": self.name + " (time to empty)",
+            "unit_of_measurement": "h",
+            "state_topic": self.state_topic("time_to_empty")
         }
+        self.duty_cycle_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_duty_cycle/config"
+        self.duty_cycle_sensor_mqtt_config = {
+            "name": self.name + " (heating duty cycle)",
+            "unit_of_measurement": "%",
+            "state_topic": self.state_topic("duty_cycle")
+        }
+        self.last_refill_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_last_refill/config"
+        self.last_refill_sensor_mqtt_config = {
+            "name": self.name + " (last refill)",
+            "device_class": "timestamp",
+            "state_topic": self.state_topic("last_refill")
+        }
+        if self.house.config.mqtt_json_state:
+            self.climate_mqtt_config["current_temperature_template"] = self.value_template("temp")
+            self.climate_mqtt_config["mode_state_template"] = self.value_template("mode")
+            self.climate_mqtt_config["temperature_state_template"] = self.value_template("target_temp")
+            self.climate_mqtt_config["availability_template"] = self.value_template("availability")
+            self.status_sensor_mqtt_config["value_template"] = self.value_template("status")
+            self.exit_temp_sensor_mqtt_config["value_template"] = self.value_template("exit_temp")
+            self.fumes_temp_sensor_mqtt_config["value_template"] = self.value_template("fumes_temp")
+            self.pellet_qty_sensor_mqtt_config["value_template"] = self.value_template("pellet_qty")
+            self.burn_rate_sensor_mqtt_config["value_template"] = self.value_template("burn_rate")
+            self.time_to_empty_sensor_mqtt_config["value_template"] = self.value_template("time_to_empty")
+            self.duty_cycle_sensor_mqtt_config["value_template"] = self.value_template("duty_cycle")
+            self.last_refill_sensor_mqtt_config["value_template"] = self.value_template("last_refill")
 
-    def register_mqtt(self):
-        mqtt_client = self.house.mqtt_client
+    def state_topic(self, field):
+        if self.house.config.mqtt_json_state:
+            field = "state"
+        return self.house.config.mqtt_state_prefix + "/" + self.device_id + "/" + field
 
-        mqtt_client.subscribe(self.climate_mqtt_config["mode_command_topic"], 0)
-        mqtt_client.subscribe(self.climate_mqtt_config["temperature_command_topic"], 0)
+    @staticmethod
+    def value_template(field):
+        return "{{ value_json." + field + " }}"
 
-        if self.house.config.mqtt_discovery:
-            retain = self.house.config.mqtt_config_retain
-            mqtt_client.publish(self.climate_discovery_topic, json.dumps(self.climate_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.status_sensor_discovery_topic, json.dumps(self.status_sensor_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.exit_temp_sensor_discovery_topic, json.dumps(self.exit_temp_sensor_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.fumes_temp_sensor_discovery_topic, json.dumps(self.fumes_temp_sensor_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.pellet_qty_sensor_discovery_topic, json.dumps(self.pellet_qty_sensor_mqtt_config),
-                                qos=1, retain=retain)
+    def discovery_configs(self):
+        configs = [
+            (self.climate_discovery_topic, self.climate_mqtt_config),
+            (self.status_sensor_discovery_topic, self.status_sensor_mqtt_config),
+            (self.exit_temp_sensor_discovery_topic, self.exit_temp_sensor_mqtt_config),
+            (self.fumes_temp_sensor_discovery_topic, self.fumes_temp_sensor_mqtt_config),
+            (self.pellet_qty_sensor_discovery_topic, self.pellet_qty_sensor_mqtt_config)
+        ]
+        if self.house.config.derived_sensors:
+            configs += [
+                (self.burn_rate_sensor_discovery_topic, self.burn_rate_sensor_mqtt_config),
+                (self.duty_cycle_sensor_discovery_topic, self.duty_cycle_sensor_mqtt_config),
+                (self.last_refill_sensor_discovery_topic, self.last_refill_sensor_mqtt_config)
+            ]
+            if self.house.config.pellet_hopper_capacity is not None:
+                configs.append((self.time_to_empty_sensor_discovery_topic, self.time_to_empty_sensor_mqtt_config))
+        return configs
 
-    def unregister_mqtt(self):
-        mqtt_client = self.house.mqtt_client
+    def register_mqtt(self):
+        self.publish_discovery()
 
-        mqtt_client.unsubscribe(self.climate_mqtt_config["mode_command_topic"], 0)
-        mqtt_client.unsubscribe(self.climate_mqtt_config["temperature_command_topic"], 0)
+    def publish_discovery(self):
+        if self.house.config.mqtt_discovery:
+            for discovery_topic, mqtt_config in self.discovery_configs():
+                self.house.publish_discovery(discovery_topic, mqtt_config)
 
+    def unregister_mqtt(self):
         if self.house.config.mqtt_discovery:
-            retain = self.house.config.mqtt_config_retain
-            mqtt_client.publish(self.climate_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.status_sensor_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.exit_temp_sensor_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.fumes_temp_sensor_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.pellet_qty_sensor_discovery_topic, None, qos=1, retain=retain)
-
-    def on_message(self, topic, payload):
-        func = self.topic_to_func.get(topic, None)
-        if func is not None:
-            func(payload)
+            for discovery_topic, mqtt_config in self.discovery_configs():
+                self.house.publish_discovery(discovery_topic, None)
 
     def send_mode(self, payload):
-        self.house.palazzetti.set_power_state(self.hostname, payload == "heat")
+        self.commands.submit("mode", self.house.palazzetti.set_power_state, self.hostname, payload == "heat")
 
     def send_target_temperature(self, target_temperature):
-        self.house.palazzetti.set_target_temperature(self.hostname, target_temperature)
+        self.commands.submit("target_temp", self.house.palazzetti.set_target_temperature,
+                             self.hostname, target_temperature)
+
+    def on_command_success(self):
+        self.house.scheduler.reset(self.hostname)
+
+    def state_values(self):
+        values = {
+            "temp": self.room_temperature,
+            "mode": self.mode,
+            "target_temp": self.target_temperature,
+            "availability": self.availability,
+            "status": self.status,
+            "exit_temp": self.exit_temperature,
+            "fumes_temp": self.fumes_temperature,
+            "pellet_qty": self.pellet_quantity
+        }
+        if self.house.config.derived_sensors:
+            values["burn_rate"] = self.pellets.burn_rate()
+            if self.house.config.pellet_hopper_capacity is not None:
+                values["time_to_empty"] = self.pellets.time_to_empty(self.house.config.pellet_hopper_capacity)
+            values["duty_cycle"] = self.pellets.duty_cycle()
+            values["last_refill"] = self.pellets.last_refill_timestamp()
+        return values
 
     def publish_state(self):
-        mqtt_client = self.house.mqtt_client
+        mqtt_client = self.house.publisher
         if mqtt_client is not None:
-            retain = self.house.config.mqtt_state_retain
-            mqtt_client.publish(self.climate_mqtt_config["current_temperature_topic"],
-                                self.room_temperature, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["mode_state_topic"],
-                                self.mode, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["temperature_state_topic"],
-                                self.target_temperature, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["availability_topic"],
-                                self.availability, retain=retain)
-            mqtt_client.publish(self.status_sensor_mqtt_config["state_topic"],
-                                self.status, retain=retain)
-            mqtt_client.publish(self.exit_temp_sensor_mqtt_config["state_topic"],
-                                self.exit_temperature, retain=retain)
-            mqtt_client.publish(self.fumes_temp_sensor_mqtt_config["state_topic"],
-                                self.fumes_temperature, retain=retain)
-            mqtt_client.publish(self.pellet_qty_sensor_mqtt_config["state_topic"],
-                                self.pellet_quantity, retain=retain)
+            config = self.house.config
+            force = time.time() - self.last_full_publish >= config.full_publish_interval
+            if force:
+                self.last_full_publish = time.time()
+            values = self.state_values()
+            changed = {field: value for field, value in values.items() if force or self.is_changed(field, value)}
+            if not changed:
+                return
+            retain = config.mqtt_state_retain
+            if config.mqtt_json_state:
+                mqtt_client.publish(self.state_topic("state"), json.dumps(values), retain=retain)
+                self.published_values.update(values)
+                self.house.metrics.increment("vihio_mqtt_published_total", 1, self.hostname)
+            else:
+                # A value that is not known yet would reach HA as an empty retained message, the JSON document
+                # keeps it as null so that the value templates render None, which HA shows as unknown
+                changed = {field: value for field, value in changed.items() if value is not None}
+                for field, value in changed.items():
+                    mqtt_client.publish(self.state_topic(field), value, retain=retain)
+                self.published_values.update(changed)
+                self.house.metrics.increment("vihio_mqtt_published_total", len(changed), self.hostname)
 
+    def is_changed(self, field, value):
+        if field not in self.published_values:
+            return True
+        setting = self.deadband_settings.get(field)
+        deadband = getattr(self.house.config, setting) if setting is not None else 0
+        return self.has_changed(self.published_values[field], value, deadband)
+
+    @staticmethod
+    def has_changed(previous, value, deadband):
+        if deadband and isinstance(previous, (int, float)) and isinstance(value, (int, float)):
+            return abs(value - previous) >= deadband
+        return value != previous
 
 ################
 
 class Config:
     devices = None
+    shard = None
+    shard_ids = None
+    base = None
     api_user_agent = 'vihio'
     mqtt_discovery_prefix = "homeassistant"
     mqtt_state_prefix = "palazzetti/state"
@@ -247,12 +347,45 @@ class Config:
     mqtt_username = None
     mqtt_password = None
     mqtt_client_name = "vihio"
+    mqtt_buffer_size = 10000
     logging_level = "INFO"
     refresh_delays = [3, 5, 10, 30]
+    idle_refresh_delays = [30, 60, 120]
     refresh_delay_randomness = 2
     offline_timeout = 120
+    poll_workers = 16
+    poll_deadline = 5
+    command_workers = 4
+    breaker_failure_threshold = 2
+    breaker_base_delay = 10
+    breaker_max_delay = 600
+    fast_poll_commands = ["GET STAT", "GET TMPS", "GET SETP"]
+    full_poll_interval = 300
+    http_host = "127.0.0.1"
+    http_port = None
+    metrics = False
+    metrics_mqtt = False
+    metrics_mqtt_interval = 60
+    trace_size = 1000
+    history_size = 720
+    history_bucket_seconds = 3600
+    history_buckets = 2160
+    derived_sensors = True
+    derived_sensors_window = 10800
+    pellet_hopper_capacity = None
+    device_cache_file = "devices.json"
+    device_cache_interval = 300
+    config_reload_interval = 10
+    shards = 1
+    shard_restart_delay = 5
+    shard_max_restarts = 5
+    shard_restart_window = 300
     temperature_unit = "°C"
     pellet_quantity_unit = "kg"
+    temperature_deadband = 0
+    pellet_quantity_deadband = 0
+    full_publish_interval = 600
+    mqtt_json_state = False
 
     def __init__(self, raw):
         self.devices = raw.get("devices")
@@ -267,31 +400,111 @@ class Config:
         self.mqtt_state_retain = raw.get("mqtt_state_retain", self.mqtt_state_retain)
         self.mqtt_username = raw.get("mqtt_username", self.mqtt_username)
         self.mqtt_password = raw.get("mqtt_password", self.mqtt_password)
+        self.mqtt_buffer_size = raw.get("mqtt_buffer_size", self.mqtt_buffer_size)
         self.mqtt_client_name = raw.get("mqtt_client_name", self.mqtt_client_name)
         self.logging_level = raw.get("logging_level", self.logging_level)
         self.refresh_delays = raw.get("refresh_delays", self.refresh_delays)
+        self.idle_refresh_delays = raw.get("idle_refresh_delays", self.idle_refresh_delays)
         self.refresh_delay_randomness = raw.get("refresh_delay_randomness", self.refresh_delay_randomness)
         self.offline_timeout = raw.get("offline_timeout", self.offline_timeout)
+        self.poll_workers = raw.get("poll_workers", self.poll_workers)
+        self.poll_deadline = raw.get("poll_deadline", self.poll_deadline)
+        self.command_workers = raw.get("command_workers", self.command_workers)
+        self.breaker_failure_threshold = raw.get("breaker_failure_threshold", self.breaker_failure_threshold)
+        self.breaker_base_delay = raw.get("breaker_base_delay", self.breaker_base_delay)
+        self.breaker_max_delay = raw.get("breaker_max_delay", self.breaker_max_delay)
+        self.fast_poll_commands = raw.get("fast_poll_commands", self.fast_poll_commands)
+        self.full_poll_interval = raw.get("full_poll_interval", self.full_poll_interval)
+        self.http_host = raw.get("http_host", self.http_host)
+        self.http_port = raw.get("http_port", self.http_port)
+        self.metrics = raw.get("metrics", self.metrics)
+        self.metrics_mqtt = raw.get("metrics_mqtt", self.metrics_mqtt)
+        self.metrics_mqtt_interval = raw.get("metrics_mqtt_interval", self.metrics_mqtt_interval)
+        self.trace_size = raw.get("trace_size", self.trace_size)
+        self.history_size = raw.get("history_size", self.history_size)
+        self.history_bucket_seconds = raw.get("history_bucket_seconds", self.history_bucket_seconds)
+        self.history_buckets = raw.get("history_buckets", self.history_buckets)
+        self.derived_sensors = raw.get("derived_sensors", self.derived_sensors)
+        self.derived_sensors_window = raw.get("derived_sensors_window", self.derived_sensors_window)
+        self.pellet_hopper_capacity = raw.get("pellet_hopper_capacity", self.pellet_hopper_capacity)
+        self.device_cache_file = raw.get("device_cache_file", self.device_cache_file)
+        self.device_cache_interval = raw.get("device_cache_interval", self.device_cache_interval)
+        self.config_reload_interval = raw.get("config_reload_interval", self.config_reload_interval)
+        self.shards = raw.get("shards", self.shards)
+        self.shard_restart_delay = raw.get("shard_restart_delay", self.shard_restart_delay)
+        self.shard_max_restarts = raw.get("shard_max_restarts", self.shard_max_restarts)
+        self.shard_restart_window = raw.get("shard_restart_window", self.shard_restart_window)
         self.temperature_unit = raw.get("temperature_unit",self.temperature_unit)
         self.pellet_quantity_unit = raw.get("pellet_quantity_unit", self.pellet_quantity_unit)
+        self.temperature_deadband = raw.get("temperature_deadband", self.temperature_deadband)
+        self.pellet_quantity_deadband = raw.get("pellet_quantity_deadband", self.pellet_quantity_deadband)
+        self.full_publish_interval = raw.get("full_publish_interval", self.full_publish_interval)
+        self.mqtt_json_state = raw.get("mqtt_json_state", self.mqtt_json_state)
 
 
 ################
 
 class PalazzettiAdapter:
     last_successful_response = 0
+    fast_poll_fields = ["SETP", "T1", "T2", "T3", "LSTATUS"]
 
-    def __init__(self):
+    def __init__(self, config, metrics):
+        self.config = config
+        self.metrics = metrics
         self.delayer = Delayer([1], 2)
         self.session = requests.Session()
+        self.breakers = {}
+        self.full_states = {}
+        # hostname -> time at which the box last failed to answer the fast poll commands
+        self.partial_unsupported = {}
 
-    def get_api(self, url, retry=1):
+    def breaker(self, hostname):
+        breaker = self.breakers.get(hostname)
+        if breaker is None:
+            breaker = self.breakers.setdefault(hostname, CircuitBreaker(self.config.breaker_failure_threshold,
+                                                                        self.config.breaker_base_delay,
+                                                                        self.config.breaker_max_delay))
+        return breaker
+
+    def configure(self, config):
+        self.config = config
+        for breaker in list(self.breakers.values()):
+            breaker.failure_threshold = config.breaker_failure_threshold
+            breaker.base_delay = config.breaker_base_delay
+            breaker.max_delay = config.breaker_max_delay
+
+    def is_available(self, hostname):
+        return self.breaker(hostname).state != CircuitBreaker.OPEN
+
+    def get_api(self, hostname, url):
+        breaker = self.breaker(hostname)
+        if not breaker.allow():
+            logging.debug("API call skipped, %s is unreachable: %s", hostname, url)
+            self.metrics.increment("vihio_api_skipped_total", 1, hostname)
+            return {}
+        response = {}
+        try:
+            response = self.call_api(hostname, url, 1 if breaker.state == CircuitBreaker.CLOSED else 0)
+        finally:
+            if response:
+                breaker.record_success()
+                self.metrics.increment("vihio_api_success_total", 1, hostname)
+            else:
+                breaker.record_failure()
+                self.metrics.increment("vihio_api_failure_total", 1, hostname)
+                if breaker.state == CircuitBreaker.OPEN:
+                    logging.warning("%s is unreachable, next attempt in %ss", hostname, breaker.delay)
+        return response
+
+    def call_api(self, hostname, url, retry=1):
         logging.debug("API call: %s", url)
+        started = time.perf_counter()
         try:
             response = self.session.get(url=url, data=None, headers=None, timeout=(2, 2))
         except Exception as e:
             logging.warning(e)
             response = None
+        self.metrics.observe("vihio_api_latency_seconds", time.perf_counter() - started, hostname)
 
         if response is None:
             status_code = -1
@@ -301,21 +514,61 @@ class PalazzettiAdapter:
         if status_code != 200:
             if retry > 0:
                 logging.debug("API call failed with status code %s. Retrying.", status_code)
+                self.metrics.increment("vihio_api_retries_total", 1, hostname)
                 time.sleep(self.delayer.next())
-                return self.get_api(url, retry - 1)
+                return self.call_api(hostname, url, retry - 1)
             else:
                 logging.debug("API call failed with status code %s. No more retry.", status_code)
                 return {}
         else:
-            logging.debug("API response: %s", response.text)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("API response: %s", response.text)
             self.last_successful_response = time.time()
-            return json.loads(response.text)
+            try:
+                return json.loads(response.text)
+            except ValueError:
+                logging.warning("API call returned an invalid payload: %s", url)
+                return {}
 
     def send_command(self, hostname, command):
-        return self.get_api("http://{}/cgi-bin/sendmsg.lua?cmd={}".format(hostname, command))
+        return self.get_api(hostname, "http://{}/cgi-bin/sendmsg.lua?cmd={}".format(hostname, command))
 
     def fetch_state(self, hostname):
-        return self.send_command(hostname, "GET ALLS")
+        full_state = self.full_states.get(hostname)
+        unsupported_at = self.partial_unsupported.get(hostname)
+        if full_state is None or not self.config.fast_poll_commands \
+                or time.time() - full_state[0] >= self.config.full_poll_interval \
+                or unsupported_at is not None and time.time() - unsupported_at < self.config.full_poll_interval:
+            return self.fetch_full_state(hostname)
+
+        data = {}
+        for command in self.config.fast_poll_commands:
+            response = self.send_command(hostname, command)
+            if not response:
+                return {}
+            if not response.get("SUCCESS", True) or "DATA" not in response:
+                break
+            data.update(response["DATA"])
+        if any(field not in data for field in self.fast_poll_fields):
+            # A busy box rejects commands too, the fast poll commands are tried again after full_poll_interval
+            if hostname not in self.partial_unsupported:
+                logging.info("%s does not support %s, falling back to GET ALLS", hostname,
+                             ", ".join(self.config.fast_poll_commands))
+            self.partial_unsupported[hostname] = time.time()
+            return self.fetch_full_state(hostname)
+        if self.partial_unsupported.pop(hostname, None) is not None:
+            logging.info("%s supports %s again", hostname, ", ".join(self.config.fast_poll_commands))
+
+        response = dict(full_state[1])
+        response["DATA"] = dict(full_state[1]["DATA"])
+        response["DATA"].update(data)
+        return response
+
+    def fetch_full_state(self, hostname):
+        response = self.send_command(hostname, "GET ALLS")
+        if "DATA" in response:
+            self.full_states[hostname] = (time.time(), response)
+        return response
 
     def set_power_state(self, hostname, power_state):
         return self.send_command(hostname, "CMD {}".format(("ON", "OFF")[power_state]))
@@ -328,6 +581,80 @@ class PalazzettiAdapter:
 
 ################
 
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold, base_delay, max_delay):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.delay = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() >= self.open_until:
+                # Let a single probe through, other calls keep failing fast until it completes
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.delay = min(self.max_delay, self.base_delay * 2 ** self.trips)
+                self.trips += 1
+                self.state = self.OPEN
+                self.open_until = time.time() + self.delay
+
+
+################
+
+class DeviceCache:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, 'r', encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except IOError:
+            logging.info("No device cache file found")
+        except ValueError:
+            logging.warning("Ignoring invalid device cache file %s", self.path)
+        return {}
+
+    def save(self, devices):
+        if self.path is None:
+            return
+        entries = {device.hostname: {"device_id": device.device_id, "data": device.last_data} for device in devices}
+        try:
+            with open(self.path + ".tmp", 'w', encoding="utf-8") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(self.path + ".tmp", self.path)
+        except IOError as e:
+            logging.warning("Could not save the device cache: %s", e)
+
+
+################
+
 class Delayer:
     def __init__(self, delays, randomness):
         self.delays = delays
@@ -337,117 +664,1080 @@ class Delayer:
     def reset(self):
         self.delay_index = 0
 
+    def configure(self, delays, randomness):
+        self.delays = delays
+        self.randomness = randomness
+        self.delay_index = min(len(self.delays) - 1, self.delay_index)
+
     def next(self):
         delay = self.delays[self.delay_index] + self.randomness * (random.random() - .5)
         self.delay_index = min(len(self.delays) - 1, self.delay_index + 1)
         return delay
 
 
+################
+
+class Scheduler:
+    def __init__(self, delays, idle_delays, randomness):
+        self.delays = delays
+        self.idle_delays = idle_delays
+        self.randomness = randomness
+        self.delayers = {}
+        self.due = {}
+        self.heap = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def add(self, key):
+        with self.lock:
+            if key not in self.delayers:
+                self.delayers[key] = (Delayer(self.delays, self.randomness),
+                                      Delayer(self.idle_delays, self.randomness))
+
+    def remove(self, key):
+        with self.lock:
+            self.delayers.pop(key, None)
+            self.due.pop(key, None)
+
+    def push(self, key, due):
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, key))
+
+    def reset(self, key):
+        with self.lock:
+            if key in self.delayers:
+                for delayer in self.delayers[key]:
+                    delayer.reset()
+                self.push(key, time.time())
+        self.wakeup.set()
+
+    def schedule(self, key, idle=False):
+        with self.lock:
+            if key not in self.delayers:
+                return
+            delayer, idle_delayer = self.delayers[key]
+            if idle:
+                delay = idle_delayer.next()
+            else:
+                idle_delayer.reset()
+                delay = delayer.next()
+            due = time.time() + delay
+            # A reset received while the key was being refreshed must not be pushed back
+            if self.due.get(key, due) >= due:
+                self.push(key, due)
+
+    def pop_due(self):
+        now = time.time()
+        keys = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, key = heapq.heappop(self.heap)
+                if self.due.get(key) == due:
+                    del self.due[key]
+                    keys.append(key)
+        return keys
+
+    def configure(self, delays, idle_delays, randomness):
+        with self.lock:
+            self.delays = delays
+            self.idle_delays = idle_delays
+            self.randomness = randomness
+            for delayer, idle_delayer in self.delayers.values():
+                delayer.configure(delays, randomness)
+                idle_delayer.configure(idle_delays, randomness)
+
+    def wait(self, limit=None):
+        with self.lock:
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+        if limit is not None and (timeout is None or timeout > limit):
+            timeout = limit
+        if timeout is None or timeout > 0:
+            self.wakeup.wait(timeout)
+        # Cleared once awake, a wakeup that came in while the caller was busy is not lost
+        self.wakeup.clear()
+
+
+################
+
+class RingBuffer:
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.times = array.array("d", bytes(8 * capacity))
+        self.values = array.array("f", bytes(4 * capacity * width))
+        self.next = 0
+        self.count = 0
+
+    def append(self, row_time, row):
+        if self.capacity == 0:
+            return
+        self.times[self.next] = row_time
+        offset = self.next * self.width
+        self.values[offset:offset + self.width] = array.array("f", row)
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def index(self, position):
+        return (self.next - self.count + position) % self.capacity
+
+    def oldest_time(self):
+        return self.times[self.index(0)] if self.count else None
+
+    def lower_bound(self, row_time):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self.index(middle)] < row_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def rows(self, start, end):
+        for position in range(self.lower_bound(start), self.count):
+            index = self.index(position)
+            if self.times[index] > end:
+                return
+            yield self.times[index], self.values[index * self.width:(index + 1) * self.width]
+
+
+################
+
+class History:
+    fields = ["temp", "exit_temp", "fumes_temp", "target_temp", "pellet_qty", "status"]
+
+    def __init__(self, size, bucket_seconds, bucket_count):
+        self.bucket_seconds = bucket_seconds
+        self.samples = RingBuffer(size, len(self.fields))
+        # Each bucket row holds the min, the max and the average of every field
+        self.buckets = RingBuffer(bucket_count, 3 * len(self.fields))
+        self.bucket_start = None
+        self.bucket_rows = None
+
+    def add(self, sample_time, values):
+        values = [float("nan") if value is None else float(value) for value in values]
+        self.samples.append(sample_time, values)
+
+        bucket_start = sample_time - sample_time % self.bucket_seconds
+        if self.bucket_start != bucket_start:
+            self.close_bucket()
+            self.bucket_start = bucket_start
+            self.bucket_rows = [[float("inf"), float("-inf"), 0.0, 0] for _ in self.fields]
+        for accumulator, value in zip(self.bucket_rows, values):
+            if value == value:
+                accumulator[0] = min(accumulator[0], value)
+                accumulator[1] = max(accumulator[1], value)
+                accumulator[2] += value
+                accumulator[3] += 1
+
+    def close_bucket(self):
+        if self.bucket_start is None:
+            return
+        self.buckets.append(self.bucket_start, self.current_row())
+
+    def current_row(self):
+        row = []
+        for minimum, maximum, total, count in self.bucket_rows:
+            if count:
+                row.extend([minimum, maximum, total / count])
+            else:
+                row.extend([float("nan")] * 3)
+        return row
+
+    def query(self, field, start=0, end=float("inf")):
+        column = self.fields.index(field)
+        oldest_sample = self.samples.oldest_time()
+        # Buckets that overlap the range or the raw samples are returned whole, their timestamps show the overlap
+        bucket_start = start - start % self.bucket_seconds
+        bucket_end = end if oldest_sample is None else min(end, oldest_sample)
+        rows = list(self.buckets.rows(bucket_start, bucket_end))
+        # The bucket being filled matters too when the raw samples do not reach back to its start
+        if self.bucket_start is not None and bucket_start <= self.bucket_start <= bucket_end:
+            rows.append((float(self.bucket_start), self.current_row()))
+        return {
+            "buckets": [[row_time] + [self.rounded(value) for value in row[3 * column:3 * column + 3]]
+                        for row_time, row in rows if row[3 * column] == row[3 * column]],
+            "samples": [[row_time, self.rounded(row[column])]
+                        for row_time, row in self.samples.rows(start, end) if row[column] == row[column]]
+        }
+
+    @staticmethod
+    def rounded(value):
+        # Values are stored as float32, 21.3 comes back as 21.299999237060547 without this
+        return float("%.7g" % value)
+
+
+################
+
+class PelletStatistics:
+    def __init__(self, window):
+        self.window = window
+        self.consumption = collections.deque()
+        self.total_consumed = 0.0
+        self.last_quantity = None
+        self.last_refill = None
+        self.periods = collections.deque()
+        self.heating_time = 0.0
+        self.total_time = 0.0
+        self.last_time = None
+        self.last_heating = False
+
+    def add(self, sample_time, quantity, heating):
+        # PQT counts the pellets consumed since the counter was last reset, which is done when refilling
+        if quantity is not None:
+            if self.last_quantity is not None:
+                if quantity < self.last_quantity:
+                    self.last_refill = sample_time
+                    self.total_consumed += quantity
+                else:
+                    self.total_consumed += quantity - self.last_quantity
+            self.last_quantity = quantity
+            self.consumption.append((sample_time, self.total_consumed))
+            while self.consumption[0][0] < sample_time - self.window:
+                self.consumption.popleft()
+
+        if self.last_time is not None:
+            duration = sample_time - self.last_time
+            self.periods.append((sample_time, duration, self.last_heating))
+            self.total_time += duration
+            if self.last_heating:
+                self.heating_time += duration
+            while self.periods[0][0] - self.periods[0][1] < sample_time - self.window:
+                start_time, duration, was_heating = self.periods.popleft()
+                self.total_time -= duration
+                if was_heating:
+                    self.heating_time -= duration
+                if not self.periods:
+                    break
+        self.last_time = sample_time
+        self.last_heating = heating
+
+    def burn_rate(self):
+        if len(self.consumption) < 2:
+            return None
+        (first_time, first_total), (last_time, last_total) = self.consumption[0], self.consumption[-1]
+        if last_time <= first_time:
+            return None
+        return round((last_total - first_total) * 3600 / (last_time - first_time), 3)
+
+    def time_to_empty(self, capacity):
+        burn_rate = self.burn_rate()
+        if capacity is None or self.last_quantity is None or not burn_rate:
+            return None
+        return round(max(0.0, capacity - self.last_quantity) / burn_rate, 1)
+
+    def duty_cycle(self):
+        if self.total_time <= 0:
+            return None
+        return round(100 * self.heating_time / self.total_time, 1)
+
+    def last_refill_timestamp(self):
+        if self.last_refill is None:
+            return None
+        return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(self.last_refill))
+
+
+################
+
+class Metrics:
+    buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, hostname=None):
+        if not self.enabled:
+            return
+        key = (name, hostname)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, hostname=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, hostname)] = value
+
+    def observe(self, name, value, hostname=None):
+        if not self.enabled:
+            return
+        key = (name, hostname)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then +Inf, then the sum of the observed values
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    @staticmethod
+    def labels(hostname, **extra):
+        labels = {} if hostname is None else {"hostname": hostname}
+        labels.update(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(key, value) for key, value in labels.items()) + "}"
+
+    def render(self):
+        lines = []
+        declared = set()
+        with self.lock:
+            for metric_type, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for (name, hostname), value in sorted(values.items(), key=str):
+                    self.declare(lines, declared, name, metric_type)
+                    lines.append("{}{} {}".format(name, self.labels(hostname), value))
+            for (name, hostname), histogram in sorted(self.histograms.items(), key=str):
+                self.declare(lines, declared, name, "histogram")
+                count = 0
+                for bucket, bucket_count in zip(self.buckets + ["+Inf"], histogram):
+                    count += bucket_count
+                    lines.append("{}_bucket{} {}".format(name, self.labels(hostname, le=bucket), count))
+                lines.append("{}_sum{} {}".format(name, self.labels(hostname), histogram[-1]))
+                lines.append("{}_count{} {}".format(name, self.labels(hostname), count))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def declare(lines, declared, name, metric_type):
+        if name not in declared:
+            declared.add(name)
+            lines.append("# TYPE {} {}".format(name, metric_type))
+
+    def summary(self):
+        summary = {}
+        with self.lock:
+            for (name, hostname), value in list(self.counters.items()) + list(self.gauges.items()):
+                summary[name] = summary.get(name, 0) + value
+            for (name, hostname), histogram in self.histograms.items():
+                if hostname is None and sum(histogram[:-1]) > 0:
+                    summary[name + "_avg"] = round(histogram[-1] / sum(histogram[:-1]), 3)
+        return summary
+
+
+################
+
+class Tracer:
+    def __init__(self, size):
+        self.records = collections.deque(maxlen=size)
+
+    @staticmethod
+    def enabled():
+        return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    def record(self, hostname, kind, payload):
+        self.records.append((time.time(), hostname, kind, payload))
+        logging.debug("%s %s: %s", hostname, kind, payload)
+
+    def dump(self):
+        return json.dumps([{"time": record_time, "hostname": hostname, "kind": kind, "payload": payload}
+                           for record_time, hostname, kind, payload in list(self.records)])
+
+    @staticmethod
+    def diff(before, after):
+        return {field: [before.get(field), value] for field, value in after.items() if before.get(field) != value}
+
+
+################
+
+class HttpEndpoint:
+    def __init__(self, host, port):
+        self.routes = {}
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                route = endpoint.routes.get(url.path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                try:
+                    content_type, body = route(urllib.parse.parse_qs(url.query))
+                except (KeyError, ValueError) as e:
+                    self.send_error(400, str(e))
+                    return
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("HTTP " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="vihio-http", daemon=True).start()
+
+
+################
+
+class CommandQueue:
+    def __init__(self, executor, on_success):
+        self.executor = executor
+        self.on_success = on_success
+        self.pending = {}
+        self.running = False
+        self.lock = threading.Lock()
+
+    def submit(self, key, func, *args):
+        # Only the latest command of each kind is kept, a burst of commands sends a single request
+        with self.lock:
+            self.pending.pop(key, None)
+            self.pending[key] = (func, args)
+            if self.running:
+                return
+            self.running = True
+        self.executor.submit(self.drain)
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    return
+                key = next(iter(self.pending))
+                func, args = self.pending.pop(key)
+            try:
+                response = func(*args)
+            except Exception as e:
+                logging.warning("Command %s failed: %s", key, e)
+                continue
+            if response and response.get("SUCCESS", True):
+                self.on_success()
+            else:
+                logging.warning("Command %s was not accepted: %s", key, response)
+
+
+################
+
+class MqttPublisher:
+    def __init__(self, mqtt_client, buffer_size, metrics, connected=False):
+        self.mqtt_client = mqtt_client
+        self.buffer_size = buffer_size
+        self.metrics = metrics
+        self.connected = connected
+        self.connections = 0
+        self.overflowed = False
+        self.on_reconnect = None
+        self.buffer = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.lock:
+            if self.connected:
+                self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+                return
+            # Only the latest message of a topic is kept, the oldest topics go first when the buffer is full
+            self.buffer.pop(topic, None)
+            self.buffer[topic] = (payload, qos, retain)
+            if len(self.buffer) > self.buffer_size:
+                self.buffer.popitem(last=False)
+                self.overflowed = True
+                self.metrics.increment("vihio_mqtt_dropped_total")
+            self.metrics.set("vihio_mqtt_buffered", len(self.buffer))
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            logging.warning("MQTT connection refused: %s", rc)
+            return
+        with self.lock:
+            logging.info("MQTT connected, publishing %d buffered messages", len(self.buffer))
+            while self.buffer:
+                topic, (payload, qos, retain) = self.buffer.popitem(last=False)
+                self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+            self.metrics.set("vihio_mqtt_buffered", 0)
+            self.connected = True
+            self.connections += 1
+            # Messages dropped from a full buffer are only recovered by publishing everything again
+            resync = self.connections > 1 or self.overflowed
+            self.overflowed = False
+        self.metrics.increment("vihio_mqtt_connections_total")
+        if self.on_reconnect is not None:
+            self.on_reconnect(resync)
+
+    def on_disconnect(self, client, userdata, *args):
+        with self.lock:
+            self.connected = False
+        logging.warning("MQTT disconnected, buffering messages until the broker is back")
+
+
 ################
 
 class House:
-    def __init__(self):
-        self.config = self.read_config()
+    config_files = ["config/default.yml", "config/local.yml"]
+    # Settings that are only read when the process starts, a reload keeps their current value
+    restart_settings = ["mqtt_host", "mqtt_port", "mqtt_username", "mqtt_password", "mqtt_client_name",
+                        "mqtt_buffer_size", "http_host", "http_port", "metrics", "poll_workers", "command_workers",
+                        "trace_size", "history_size", "history_bucket_seconds", "history_buckets",
+                        "derived_sensors_window", "device_cache_file", "logging_level", "shards", "shard", "shard_ids"]
+    # Settings that change the MQTT topics or the discovery configs
+    mqtt_settings = ["mqtt_discovery_prefix", "mqtt_state_prefix", "mqtt_command_prefix", "mqtt_reset_topic",
+                     "mqtt_discovery", "mqtt_config_retain", "mqtt_json_state", "temperature_unit",
+                     "pellet_quantity_unit", "derived_sensors", "pellet_hopper_capacity"]
+
+    def __init__(self, config=None, mqtt_client=None):
+        self.config_file_mtimes = self.config_mtimes()
+        self.config = config if config is not None else self.read_config()
         logging.basicConfig(level=self.config.logging_level, format="%(asctime)-15s %(levelname)-8s %(message)s")
-        self.mqtt_client = mqtt.Client(self.config.mqtt_client_name)
-        if self.config.mqtt_username is not None:
-            self.mqtt_client.username_pw_set(self.config.mqtt_username, self.config.mqtt_password)
-        self.mqtt_client.connect(self.config.mqtt_host, self.config.mqtt_port)
+        self.metrics = Metrics(self.config.metrics)
+        self.mqtt_client = mqtt_client
+        # A client handed over by the caller is expected to be connected already
+        self.publisher = MqttPublisher(self.mqtt_client, self.config.mqtt_buffer_size, self.metrics,
+                                       connected=mqtt_client is not None)
+        if self.mqtt_client is None:
+            self.mqtt_client = mqtt.Client(self.config.mqtt_client_name)
+            if self.config.mqtt_username is not None:
+                self.mqtt_client.username_pw_set(self.config.mqtt_username, self.config.mqtt_password)
+            self.publisher.mqtt_client = self.mqtt_client
+            self.mqtt_client.on_connect = self.publisher.on_connect
+            self.mqtt_client.on_disconnect = self.publisher.on_disconnect
+            # The network loop retries in the background, the broker does not have to be up when Vihio starts
+            self.mqtt_client.connect_async(self.config.mqtt_host, self.config.mqtt_port)
+        self.publisher.on_reconnect = self.on_reconnect
         self.devices = {}
-        self.delayer = Delayer(self.config.refresh_delays, self.config.refresh_delay_randomness)
-        self.palazzetti = PalazzettiAdapter()
+        self.devices_by_hostname = {}
+        self.device_cache = DeviceCache(self.config.device_cache_file)
+        self.device_cache_changed = False
+        self.last_device_cache_save = time.time()
+        self.scheduler = Scheduler(self.config.refresh_delays, self.config.idle_refresh_delays,
+                                   self.config.refresh_delay_randomness)
+        for device_cfg in self.config.devices:
+            self.scheduler.add(device_cfg["hostname"])
+        self.reset_requested = False
+        self.resync_requested = False
+        self.discovery_hashes = {}
+        self.routes = {}
+        self.palazzetti = PalazzettiAdapter(self.config, self.metrics)
+        self.last_diagnostics = 0
+        self.tracer = Tracer(self.config.trace_size)
+        self.http_endpoint = None
+        if self.config.http_port is not None:
+            self.http_endpoint = HttpEndpoint(self.config.http_host, self.config.http_port)
+            if self.config.metrics:
+                self.http_endpoint.routes["/metrics"] = \
+                    lambda query: ("text/plain; version=0.0.4", self.metrics.render())
+            self.http_endpoint.routes["/trace"] = lambda query: ("application/json", self.tracer.dump())
+            self.http_endpoint.routes["/history"] = self.history_route
+        self.poll_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.poll_workers,
+                                                                   thread_name_prefix="vihio-poll")
+        self.pending_polls = {}
+        self.command_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.command_workers,
+                                                                      thread_name_prefix="vihio-command")
 
     @staticmethod
     def read_config():
-        with open("config/default.yml", 'r', encoding="utf-8") as yml_file:
+        with open(House.config_files[0], 'r', encoding="utf-8") as yml_file:
             raw_default_config = yaml.safe_load(yml_file)
 
+        if not isinstance(raw_default_config, dict):
+            raise ValueError("{} is not a mapping".format(House.config_files[0]))
+
         try:
-            with open("config/local.yml", 'r', encoding="utf-8") as yml_file:
+            with open(House.config_files[1], 'r', encoding="utf-8") as yml_file:
                 raw_local_config = yaml.safe_load(yml_file)
-                raw_default_config.update(raw_local_config)
         except IOError:
             logging.info("No local config file found")
+        else:
+            # An editor may truncate the file before writing it, an empty file is not taken as "no override"
+            if not isinstance(raw_local_config, dict):
+                raise ValueError("{} is not a mapping".format(House.config_files[1]))
+            raw_default_config.update(raw_local_config)
+
+        devices = raw_default_config.get("devices")
+        if not isinstance(devices, list):
+            raise ValueError("devices must be a list")
+        for device_cfg in devices:
+            if not isinstance(device_cfg, dict) or "name" not in device_cfg or "hostname" not in device_cfg:
+                raise ValueError("every device needs a name and a hostname: {}".format(device_cfg))
 
         return Config(raw_default_config)
 
-    def register_all(self):
-        self.mqtt_client.loop_start()
+    @staticmethod
+    def config_mtimes():
+        mtimes = []
+        for path in House.config_files:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload_config(self):
+        mtimes = self.config_mtimes()
+        if mtimes == self.config_file_mtimes:
+            return
+        try:
+            config = self.read_config()
+        except (IOError, ValueError, yaml.YAMLError) as e:
+            # The current configuration stays, the files are read again on the next check
+            logging.error("Could not reload the configuration: %s", e)
+            return
+        self.config_file_mtimes = mtimes
+        logging.info("Configuration changed, reloading")
+        self.apply_config(config)
+
+    def apply_config(self, config):
+        # Shard workers override some settings, the file is compared with what it said before these overrides
+        base = self.config.base if self.config.base is not None else self.config
+        file_config = copy.copy(config)
+        for setting in self.restart_settings:
+            if getattr(config, setting) != getattr(base, setting):
+                logging.warning("Restart Vihio to apply the new %s", setting)
+            setattr(config, setting, getattr(self.config, setting))
+        config.base = file_config
+        if config.shard is not None:
+            config.devices = [device_cfg for device_cfg in config.devices
+                              if shard_for(device_cfg["hostname"], config.shard_ids) == config.shard]
+        previous = self.config
+        mqtt_changed = any(getattr(config, setting) != getattr(previous, setting) for setting in self.mqtt_settings)
+        previous_devices = {device_cfg["hostname"]: device_cfg for device_cfg in previous.devices}
+        devices = {device_cfg["hostname"]: device_cfg for device_cfg in config.devices}
+
+        if mqtt_changed:
+            self.mqtt_client.unsubscribe(previous.mqtt_reset_topic, 0)
+            self.mqtt_client.unsubscribe(previous.mqtt_command_prefix + "/+/+", 0)
+        for hostname in previous_devices.keys() - devices.keys():
+            device = self.device_by_hostname(hostname)
+            if device is not None:
+                logging.info("Device removed: %s (%s | %s)", device.name, device.device_id, device.hostname)
+                self.remove_device(device)
+            self.scheduler.remove(hostname)
+        previous_topics = self.discovery_topics()
+
+        self.config = config
+        self.palazzetti.configure(config)
+        self.scheduler.configure(config.refresh_delays, config.idle_refresh_delays, config.refresh_delay_randomness)
+
+        if mqtt_changed:
+            self.routes = {}
+        for device in self.devices.values():
+            name = devices[device.hostname]["name"]
+            renamed = name != device.name
+            device.name = name
+            if device.climate_mqtt_config is not None and (mqtt_changed or renamed):
+                self.setup_device(device)
+                if not mqtt_changed:
+                    device.publish_discovery()
+        if mqtt_changed:
+            self.register_all()
+        # Discovery configs that are not published any more would show up as stale entities in HA
+        for topic in previous_topics - self.discovery_topics():
+            self.publish_discovery(topic, None)
+        for hostname in devices.keys() - previous_devices.keys():
+            self.scheduler.add(hostname)
+            self.scheduler.reset(hostname)
+
+    def discovery_topics(self):
+        if not self.config.mqtt_discovery:
+            return set()
+        return {topic for device in self.devices.values() if device.climate_mqtt_config is not None
+                for topic, mqtt_config in device.discovery_configs()}
+
+    def subscribe_all(self):
         self.mqtt_client.subscribe(self.config.mqtt_reset_topic, 0)
+        self.mqtt_client.subscribe(self.config.mqtt_command_prefix + "/+/+", 0)
+
+    def register_all(self):
+        self.subscribe_all()
         for device_id, device in self.devices.items():
             device.register_mqtt()
+        self.publish_diagnostics_discovery()
         self.mqtt_client.on_message = self.on_message
 
+    def publish_discovery(self, topic, mqtt_config):
+        # Discovery configs are retained, an identical config already published is not sent again
+        if mqtt_config is None:
+            self.discovery_hashes.pop(topic, None)
+            self.publisher.publish(topic, None, qos=1, retain=self.config.mqtt_config_retain)
+            return
+        payload = json.dumps(mqtt_config)
+        digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        if self.discovery_hashes.get(topic) == digest:
+            return
+        self.publisher.publish(topic, payload, qos=1, retain=self.config.mqtt_config_retain)
+        self.discovery_hashes[topic] = digest
+
+    def publish_diagnostics_discovery(self):
+        if self.config.metrics and self.config.metrics_mqtt and self.config.mqtt_discovery:
+            self.publish_discovery(self.diagnostics_discovery_topic(), self.diagnostics_mqtt_config())
+
+    def history_route(self, query):
+        device = self.devices[query["device"][0]]
+        start = float(query.get("start", [0])[0])
+        end = float(query.get("end", [float("inf")])[0])
+        return "application/json", json.dumps(device.history.query(query["field"][0], start, end))
+
+    def diagnostics_topic(self):
+        return self.config.mqtt_state_prefix + "/" + self.config.mqtt_client_name + "/diagnostics"
+
+    def diagnostics_discovery_topic(self):
+        return self.config.mqtt_discovery_prefix + "/sensor/" + self.config.mqtt_client_name + "_diagnostics/config"
+
+    def diagnostics_mqtt_config(self):
+        return {
+            "name": self.config.mqtt_client_name + " (cycle time)",
+            "unique_id": self.config.mqtt_client_name + "_diagnostics",
+            "unit_of_measurement": "s",
+            "state_topic": self.diagnostics_topic(),
+            "value_template": "{{ value_json.vihio_cycle_seconds_avg }}",
+            "json_attributes_topic": self.diagnostics_topic()
+        }
+
+    def publish_diagnostics(self):
+        if not self.config.metrics or not self.config.metrics_mqtt \
+                or time.time() - self.last_diagnostics < self.config.metrics_mqtt_interval:
+            return
+        self.last_diagnostics = time.time()
+        self.publisher.publish(self.diagnostics_topic(), json.dumps(self.metrics.summary()),
+                               retain=self.config.mqtt_state_retain)
+
     def unregister_all(self):
-        self.mqtt_client.on_message(None)
+        self.mqtt_client.on_message = None
         self.mqtt_client.unsubscribe(self.config.mqtt_reset_topic, 0)
+        self.mqtt_client.unsubscribe(self.config.mqtt_command_prefix + "/+/+", 0)
         for device_id, device in self.devices.items():
             device.unregister_mqtt()
         self.mqtt_client.loop_stop()
 
-    def update_all_states(self):
-        logging.debug("update_all_states: begin")
-        logging.debug("devices at beginning: %s", str(self.devices))
+    def poll_all(self, hostnames):
+        # A host that is still busy with a previous poll keeps its pending request, so a hung box never
+        # accumulates more than one in-flight request and never holds up the other boxes.
+        submitted = []
+        for hostname in hostnames:
+            if hostname not in self.pending_polls:
+                self.pending_polls[hostname] = self.poll_executor.submit(self.palazzetti.fetch_state, hostname)
+                submitted.append(self.pending_polls[hostname])
+        concurrent.futures.wait(submitted, timeout=self.config.poll_deadline)
+
+        results = {}
+        for hostname, future in list(self.pending_polls.items()):
+            if not future.done():
+                if hostname in hostnames:
+                    logging.warning("No response from %s within %ss", hostname, self.config.poll_deadline)
+                continue
+            del self.pending_polls[hostname]
+            if future.exception() is not None:
+                logging.warning("Polling %s failed: %s", hostname, future.exception())
+                continue
+            results[hostname] = future.result()
+        return results
+
+    def update_all_states(self, hostnames):
+        tracing = self.tracer.enabled()
+        updated = []
+        raw_devices = self.poll_all(hostnames)
         for device_cfg in self.config.devices:
-            logging.debug("update_all_states: %s begin", device_cfg["hostname"])
-            raw_device = self.palazzetti.fetch_state(device_cfg["hostname"])
-            logging.debug("update_all_states: raw_device %s", json.dumps(raw_device))
+            if device_cfg["hostname"] not in raw_devices:
+                continue
+            raw_device = raw_devices[device_cfg["hostname"]]
+            if tracing:
+                self.tracer.record(device_cfg["hostname"], "payload", raw_device)
+            if not raw_device:
+                # A box is offline once its breaker opens or it has not answered for offline_timeout seconds
+                device = self.device_by_hostname(device_cfg["hostname"])
+                if device is not None and device.availability != "offline" \
+                        and (not self.palazzetti.is_available(device.hostname)
+                             or time.time() - device.last_update >= self.config.offline_timeout):
+                    device.availability = "offline"
+                    updated.append(device)
+                continue
             try:
                 device_id = raw_device["DATA"]["MAC"].replace(':', '_')
             except KeyError:
-                logging.debug("Payload received: %s", json.dumps(raw_device))
-                logging.error("Device response payload is missing a MAC identifier")
-                return
-            logging.debug("update_all_states: device_id %s", device_id)
+                logging.error("Device response payload from %s is missing a MAC identifier", device_cfg["hostname"])
+                continue
+            previous = self.device_by_hostname(device_cfg["hostname"])
+            if previous is not None and previous.device_id != device_id:
+                logging.info("%s now answers as %s instead of %s", previous.hostname, device_id, previous.device_id)
+                self.remove_device(previous)
             if device_id in self.devices:
                 device = self.devices[device_id]
             else:
                 device = Device(self, device_id,  device_cfg["name"], device_cfg["hostname"])
-                self.devices[device.device_id] = device
-            logging.debug("device before update: %s", str(device))
+                self.add_device(device)
+            before = device.state_values() if tracing else None
             device.update_state(raw_device["DATA"])
-            logging.debug("device after update: %s", str(device))
-        logging.debug("devices at end: %s", str(self.devices))
-        logging.debug("update_all_states: end")
+            updated.append(device)
+            if tracing:
+                self.tracer.record(device.hostname, "changes", Tracer.diff(before, device.state_values()))
+        return updated
 
-    def refresh_all(self):
-        self.update_all_states()
-        for device in self.devices.values():
+    def device_by_hostname(self, hostname):
+        return self.devices_by_hostname.get(hostname)
+
+    def add_device(self, device):
+        self.devices[device.device_id] = device
+        self.devices_by_hostname[device.hostname] = device
+        self.device_cache_changed = True
+
+    def remove_device(self, device):
+        if device.climate_mqtt_config is not None:
+            device.unregister_mqtt()
+            for topic in device.topic_to_func:
+                self.routes.pop(topic, None)
+        del self.devices[device.device_id]
+        if self.devices_by_hostname.get(device.hostname) is device:
+            del self.devices_by_hostname[device.hostname]
+        self.device_cache_changed = True
+
+    def restore_devices(self):
+        cached = self.device_cache.load()
+        for device_cfg in self.config.devices:
+            entry = cached.get(device_cfg["hostname"])
+            if entry is None or self.device_by_hostname(device_cfg["hostname"]) is not None:
+                continue
+            device = Device(self, entry["device_id"], device_cfg["name"], device_cfg["hostname"])
+            if entry.get("data"):
+                device.restore_state(entry["data"])
+            self.add_device(device)
+        self.device_cache_changed = False
+
+    def save_device_cache(self):
+        if self.device_cache_changed or time.time() - self.last_device_cache_save >= self.config.device_cache_interval:
+            self.device_cache.save(self.devices.values())
+            self.device_cache_changed = False
+            self.last_device_cache_save = time.time()
+
+    def schedule_all(self, hostnames):
+        for hostname in hostnames:
+            device = self.device_by_hostname(hostname)
+            self.scheduler.schedule(hostname, idle=device is not None and device.mode == "off")
+
+    def refresh(self, hostnames):
+        started = time.perf_counter()
+        devices = self.update_all_states(hostnames)
+        polled = time.perf_counter()
+        for device in devices:
+            if device.climate_mqtt_config is None:
+                self.setup_device(device)
+                device.register_mqtt()
             device.publish_state()
+        self.schedule_all(hostnames)
+        self.save_device_cache()
+        if hostnames:
+            self.metrics.observe("vihio_poll_seconds", polled - started)
+            self.metrics.observe("vihio_publish_seconds", time.perf_counter() - polled)
+            self.metrics.observe("vihio_cycle_seconds", time.perf_counter() - started)
+            self.metrics.set("vihio_devices", len(self.devices))
+            # paho does not expose its outgoing queue, this is the best estimate available
+            self.metrics.set("vihio_mqtt_queue_depth", len(getattr(self.mqtt_client, "_out_messages", ())))
+
+    def setup_device(self, device):
+        device.update_mqtt_config()
+        # Commands are dispatched with a single lookup of the full topic
+        for topic, func in device.topic_to_func.items():
+            self.routes[topic] = (device, func)
+        logging.info("Device found: %s (%s | %s)", device.name, device.device_id, device.hostname)
 
     def setup(self):
-        self.update_all_states()
+        # Known devices are registered right away, the boxes confirm or correct them as they answer
+        self.restore_devices()
         for device in self.devices.values():
-            device.update_mqtt_config()
-            logging.info("Device found: %s (%s | %s)", device.name, device.device_id, device.hostname)
+            self.setup_device(device)
 
-    def loop_start(self):
+    def start(self):
         self.setup()
         self.register_all()
+        for device_cfg in self.config.devices:
+            self.scheduler.reset(device_cfg["hostname"])
+
+    def reset(self, full=False):
+        # Retained discovery configs survive a Home Assistant restart, only what changed is published again
+        if full or not self.config.mqtt_config_retain:
+            self.discovery_hashes = {}
+        self.restore_devices()
+        for device in self.devices.values():
+            if full or not self.config.mqtt_state_retain:
+                device.published_values = {}
+            if device.climate_mqtt_config is None:
+                self.setup_device(device)
+                device.register_mqtt()
+            else:
+                device.publish_discovery()
+            if full and device.last_data is not None:
+                device.publish_state()
+        self.publish_diagnostics_discovery()
+
+    def on_reconnect(self, resync):
+        # Runs on the MQTT network thread, the main loop does the actual work
+        self.subscribe_all()
+        if resync:
+            # The broker may have restarted without its retained messages
+            self.resync_requested = True
+            self.scheduler.wakeup.set()
+
+    def loop_start(self):
+        if self.http_endpoint is not None:
+            self.http_endpoint.start()
+        self.mqtt_client.loop_start()
+        self.start()
+        self.run()
+
+    def run(self):
+        last_reload_check = time.time()
         while True:
-            self.refresh_all()
-            time.sleep(self.delayer.next())
+            started = time.perf_counter()
+            self.scheduler.wait(self.config.config_reload_interval or None)
+            self.metrics.observe("vihio_sleep_seconds", time.perf_counter() - started)
+            if self.config.config_reload_interval and \
+                    time.time() - last_reload_check >= self.config.config_reload_interval:
+                last_reload_check = time.time()
+                self.reload_config()
+            if self.reset_requested or self.resync_requested:
+                full = self.resync_requested
+                self.reset_requested = False
+                self.resync_requested = False
+                self.reset(full)
+            self.refresh(self.scheduler.pop_due())
+            self.publish_diagnostics()
 
     def on_message(self, client, userdata, message):
         if message.topic == self.config.mqtt_reset_topic:
-            self.setup()
-            self.register_all()
+            # Only Vihio knows what it published, "full" covers the retained configs the broker has lost since
+            if message.payload == b"full":
+                self.resync_requested = True
+            else:
+                self.reset_requested = True
+            self.scheduler.wakeup.set()
+            return
+
+        route = self.routes.get(message.topic)
+        if route is None:
+            logging.debug("MQTT message ignored on unknown topic '%s'", message.topic)
             return
+        device, func = route
+        try:
+            value = message.payload.decode("utf-8")
+        except UnicodeDecodeError:
+            logging.warning("MQTT message ignored on '%s': invalid payload", message.topic)
+            return
+        logging.info("MQTT message received device '%s' topic '%s' value '%s'", device.device_id, message.topic, value)
+        func(value)
+
+
+################
+
+class Supervisor:
+    def __init__(self, config):
+        self.config = config
+        logging.basicConfig(level=self.config.logging_level, format="%(asctime)-15s %(levelname)-8s %(message)s")
+        self.shards = list(range(self.config.shards))
+        self.assignment = {}
+        self.processes = {}
+        self.restarts = {}
+        self.restart_at = {}
+        self.config_file_mtimes = House.config_mtimes()
+
+    def assign(self):
+        assignment = {shard: [] for shard in self.shards}
+        for device_cfg in self.config.devices:
+            assignment[shard_for(device_cfg["hostname"], self.shards)].append(device_cfg)
+        return assignment
+
+    def reload_config(self):
+        mtimes = House.config_mtimes()
+        if mtimes == self.config_file_mtimes:
+            return
+        try:
+            config = House.read_config()
+        except (IOError, ValueError, yaml.YAMLError) as e:
+            # The current configuration stays, the files are read again on the next check
+            logging.error("Could not reload the configuration: %s", e)
+            return
+        self.config_file_mtimes = mtimes
+        # The workers reload the file on their own, the new assignment is only used to restart them
+        config.shards = self.config.shards
+        self.config = config
+        self.assignment = self.assign()
+
+    def shard_config(self, shard):
+        config = copy.copy(self.config)
+        config.base = self.config
+        config.devices = self.assignment[shard]
+        config.shard = shard
+        config.shard_ids = list(self.shards)
+        config.mqtt_client_name = "{}-{}".format(self.config.mqtt_client_name, shard)
+        if self.config.http_port is not None:
+            config.http_port = self.config.http_port + shard
+        if self.config.device_cache_file is not None:
+            root, extension = os.path.splitext(self.config.device_cache_file)
+            config.device_cache_file = "{}-{}{}".format(root, shard, extension)
+        return config
+
+    def start_worker(self, shard):
+        process = multiprocessing.Process(target=run_worker, args=(self.shard_config(shard),),
+                                          name="vihio-shard-{}".format(shard), daemon=True)
+        process.start()
+        self.processes[shard] = process
+        logging.info("Shard %s started with %s devices (pid %s)", shard, len(self.assignment[shard]), process.pid)
+
+    def stop_worker(self, shard):
+        process = self.processes.pop(shard, None)
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join()
+
+    def rebalance(self):
+        # Every worker filters the devices added by a reload with the list of shards it was started with,
+        # so all of them are restarted when that list changes
+        self.assignment = self.assign()
+        for shard in self.shards:
+            self.restart_at.pop(shard, None)
+            self.stop_worker(shard)
+            self.start_worker(shard)
+
+    def on_worker_exit(self, shard):
+        now = time.time()
+        logging.warning("Shard %s exited with code %s", shard, self.processes[shard].exitcode)
+        del self.processes[shard]
+        restarts = [restart for restart in self.restarts.get(shard, []) if restart > now - self.config.shard_restart_window]
+        restarts.append(now)
+        self.restarts[shard] = restarts
+        if len(restarts) > self.config.shard_max_restarts and len(self.shards) > 1:
+            logging.error("Shard %s keeps failing, moving its devices to the other shards", shard)
+            self.shards.remove(shard)
+            del self.assignment[shard]
+            self.rebalance()
+        else:
+            self.restart_at[shard] = now + self.config.shard_restart_delay
+
+    def loop_start(self):
+        self.assignment = self.assign()
+        for shard in self.shards:
+            self.start_worker(shard)
+        while True:
+            time.sleep(1)
+            self.reload_config()
+            for shard in list(self.processes):
+                if not self.processes[shard].is_alive():
+                    self.on_worker_exit(shard)
+            for shard, restart_at in list(self.restart_at.items()):
+                if time.time() >= restart_at:
+                    del self.restart_at[shard]
+                    self.start_worker(shard)
+
 
-        topic_tokens = message.topic.split('/')
-        # TODO validation
+def shard_for(hostname, shards):
+    # Rendezvous hashing: when a shard goes away only its own devices move to the other shards
+    return max(shards, key=lambda shard: zlib.crc32("{}/{}".format(shard, hostname).encode("utf-8")))
 
-        device_id = topic_tokens[len(topic_tokens) - 2]
-        command = topic_tokens[len(topic_tokens) - 1]
-        value = str(message.payload.decode("utf-8"))
-        logging.info("MQTT message received device '%s' command '%s' value '%s'", device_id, command, value)
 
-        device = self.devices.get(device_id, None)
-        if device is not None:
-            device.on_message(message.topic, value)
-        self.delayer.reset()
+def run_worker(config):
+    House(config).loop_start()
 
 
 ################
 
-House().loop_start()
+if __name__ == "__main__":
+    house_config = House.read_config()
+    if house_config.shards > 1:
+        Supervisor(house_config).loop_start()
+    else:
+        House(house_config).loop_start()
@@ -0,0 +1,154 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import statistics
+import threading
+import time
+
+import simulator
+from Vihio import House
+
+
+################
+
+class MqttMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode("utf-8")
+
+
+class FakeMqttClient:
+    def __init__(self):
+        self.on_message = None
+        self.subscriptions = set()
+        self.published = 0
+        self.last_payloads = {}
+        self.lock = threading.Lock()
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+
+    def unsubscribe(self, topic, properties=None):
+        self.subscriptions.discard(topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.lock:
+            self.published += 1
+            self.last_payloads[topic] = payload
+
+    def deliver(self, topic, payload):
+        self.on_message(self, None, MqttMessage(topic, payload))
+
+    def last_payload(self, topic):
+        with self.lock:
+            return self.last_payloads.get(topic)
+
+
+################
+
+def serve_simulator(args, ready):
+    stoves = simulator.Simulator(args.stoves, args.host, args.port, **simulator.behaviour(args))
+    stoves.start()
+    ready.set()
+    while True:
+        time.sleep(3600)
+
+
+def published_target_temperature(mqtt_client, device):
+    payload = mqtt_client.last_payload(device.state_topic("target_temp"))
+    if device.house.config.mqtt_json_state and payload is not None:
+        payload = json.loads(payload)["target_temp"]
+    return payload
+
+
+def measure_cycles(house, hostnames, cycles):
+    durations = []
+    messages = []
+    for _ in range(cycles):
+        published = house.mqtt_client.published
+        started = time.perf_counter()
+        house.refresh(hostnames)
+        durations.append(time.perf_counter() - started)
+        messages.append(house.mqtt_client.published - published)
+    return durations, messages
+
+
+def measure_commands(house, commands, timeout):
+    threading.Thread(target=house.run, daemon=True).start()
+    latencies = []
+    devices = list(house.devices.values())
+    for index in range(commands):
+        device = devices[index % len(devices)]
+        target_temperature = 15.0 + index % 10
+        if published_target_temperature(house.mqtt_client, device) == target_temperature:
+            target_temperature += 0.5
+        started = time.perf_counter()
+        house.mqtt_client.deliver(device.climate_mqtt_config["temperature_command_topic"], str(target_temperature))
+        while time.perf_counter() - started < timeout:
+            if published_target_temperature(house.mqtt_client, device) == target_temperature:
+                latencies.append(time.perf_counter() - started)
+                break
+            time.sleep(0.005)
+    return latencies
+
+
+def report(name, values, unit):
+    if not values:
+        print("{:<28} no sample".format(name))
+        return
+    ordered = sorted(values)
+    print("{:<28} min {:9.3f}{}  median {:9.3f}{}  p95 {:9.3f}{}  max {:9.3f}{}".format(
+        name, ordered[0], unit, statistics.median(ordered), unit,
+        ordered[min(len(ordered) - 1, int(len(ordered) * .95))], unit, ordered[-1], unit))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs Vihio against simulated Palazzetti boxes")
+    simulator.add_arguments(parser)
+    parser.add_argument("--cycles", type=int, default=10, help="number of full refresh cycles to measure")
+    parser.add_argument("--commands", type=int, default=20, help="number of commands to measure")
+    parser.add_argument("--command-timeout", type=float, default=30.0, help="seconds to wait for a command")
+    parser.add_argument("--poll-workers", type=int, default=None, help="overrides poll_workers")
+    parser.add_argument("--json-state", action="store_true", help="publishes the state as a single JSON topic")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    simulator_process = multiprocessing.Process(target=serve_simulator, args=(args, ready), daemon=True)
+    simulator_process.start()
+    ready.wait()
+
+    config = House.read_config()
+    config.devices = [{"name": "Simulated stove {}".format(index), "hostname": "{}:{}".format(args.host, args.port + index)}
+                      for index in range(args.stoves)]
+    config.mqtt_json_state = args.json_state
+    config.http_port = None
+    config.device_cache_file = None
+    config.logging_level = "WARNING"
+    if args.poll_workers is not None:
+        config.poll_workers = args.poll_workers
+    house = House(config, FakeMqttClient())
+    logging.getLogger().setLevel(config.logging_level)
+    hostnames = [device_cfg["hostname"] for device_cfg in config.devices]
+
+    started = time.perf_counter()
+    house.start()
+    house.refresh(house.scheduler.pop_due())
+    print("{:<28} {:.3f}s for {} stoves, {} found".format("startup", time.perf_counter() - started,
+                                                          args.stoves, len(house.devices)))
+    durations, messages = measure_cycles(house, hostnames, args.cycles)
+    report("refresh cycle", durations, "s")
+    report("messages per cycle", messages, "")
+    latencies = measure_commands(house, args.commands, args.command_timeout)
+    report("command to state", latencies, "s")
+    print("{:<28} {}/{}".format("commands confirmed", len(latencies), args.commands))
+    print("{:<28} {:.1f} MB".format("max resident memory", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    logging.disable(logging.CRITICAL)
+    simulator_process.terminate()
@@ -0,0 +1,181 @@
+import argparse
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+
+################
+
+class SimulatedStove:
+    partial_commands = {
+        "GET STAT": ["STATUS", "LSTATUS"],
+        "GET TMPS": ["T1", "T2", "T3", "T4", "T5"],
+        "GET SETP": ["SETP"]
+    }
+
+    def __init__(self, index, latency=0.0, error_rate=0.0, hang_rate=0.0, hang_duration=30.0,
+                 missing_mac_rate=0.0, legacy_firmware=False):
+        self.mac = "AA:BB:CC:{:02X}:{:02X}:{:02X}".format(index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_duration = hang_duration
+        self.missing_mac_rate = missing_mac_rate
+        self.legacy_firmware = legacy_firmware
+        self.lock = threading.Lock()
+        self.random = random.Random(index)
+        self.setpoint = 20.0
+        self.room_temperature = 18.0 + self.random.random() * 3
+        self.pellet_quantity = self.random.random() * 10
+        self.status = 0
+        self.last_step = time.time()
+
+    def step(self):
+        now = time.time()
+        elapsed = now - self.last_step
+        self.last_step = now
+        if self.status == 6:
+            self.room_temperature += min(self.setpoint - self.room_temperature, elapsed * 0.01)
+            self.pellet_quantity += elapsed * 0.0003
+        else:
+            self.room_temperature -= min(self.room_temperature - 15, elapsed * 0.002)
+
+    def data(self):
+        return {
+            "MAC": self.mac,
+            "SETP": self.setpoint,
+            "T1": round(self.room_temperature, 1),
+            "T2": 60.0 if self.status == 6 else 20.0,
+            "T3": 120.0 if self.status == 6 else 20.0,
+            "T4": 0.0,
+            "T5": 0.0,
+            "PQT": "{:.2f}".format(self.pellet_quantity),
+            "STATUS": self.status,
+            "LSTATUS": self.status
+        }
+
+    def handle(self, command):
+        if self.latency:
+            time.sleep(self.latency * (0.5 + self.random.random()))
+        if self.random.random() < self.hang_rate:
+            time.sleep(self.hang_duration)
+        if self.random.random() < self.error_rate:
+            return 500, "Internal Server Error"
+
+        with self.lock:
+            self.step()
+            if command == "GET ALLS":
+                data = self.data()
+                if self.random.random() < self.missing_mac_rate:
+                    del data["MAC"]
+                return 200, json.dumps({"SUCCESS": True, "DATA": data})
+            if command in self.partial_commands and not self.legacy_firmware:
+                data = self.data()
+                return 200, json.dumps({"SUCCESS": True,
+                                        "DATA": {field: data[field] for field in self.partial_commands[command]}})
+            if command in ("CMD ON", "CMD OFF"):
+                self.status = 6 if command == "CMD ON" else 0
+                return 200, json.dumps({"SUCCESS": True, "DATA": self.data()})
+            if command.startswith("SET SETP "):
+                try:
+                    self.setpoint = float(command[len("SET SETP "):])
+                except ValueError:
+                    return 200, json.dumps({"SUCCESS": False, "INFO": {"MSG": "Invalid value"}})
+                return 200, json.dumps({"SUCCESS": True, "DATA": {"SETP": self.setpoint}})
+        return 200, json.dumps({"SUCCESS": False, "INFO": {"MSG": "Unknown command"}})
+
+
+################
+
+class Simulator:
+    def __init__(self, count, host="127.0.0.1", base_port=18000, **behaviour):
+        self.host = host
+        self.stoves = {}
+        self.servers = []
+        for index in range(count):
+            stove = SimulatedStove(index, **behaviour)
+            server = http.server.ThreadingHTTPServer((host, base_port + index), self.handler(stove))
+            server.daemon_threads = True
+            self.stoves["{}:{}".format(host, base_port + index)] = stove
+            self.servers.append(server)
+
+    @staticmethod
+    def handler(stove):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path != "/cgi-bin/sendmsg.lua":
+                    self.send_error(404)
+                    return
+                command = urllib.parse.parse_qs(url.query).get("cmd", [""])[0]
+                status, body = stove.handle(command)
+                body = body.encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                logging.debug("HTTP " + format, *args)
+
+        return Handler
+
+    def hostnames(self):
+        return list(self.stoves)
+
+    def start(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+################
+
+def add_arguments(parser):
+    parser.add_argument("--stoves", type=int, default=10, help="number of simulated boxes")
+    parser.add_argument("--host", default="127.0.0.1", help="address the simulated boxes listen on")
+    parser.add_argument("--port", type=int, default=18000, help="port of the first box, the others follow")
+    parser.add_argument("--latency", type=float, default=0.05, help="average response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="share of requests that hang")
+    parser.add_argument("--hang-duration", type=float, default=30.0, help="duration of a hang in seconds")
+    parser.add_argument("--missing-mac-rate", type=float, default=0.0, help="share of GET ALLS without a MAC")
+    parser.add_argument("--legacy-firmware", action="store_true", help="reject GET STAT, GET TMPS and GET SETP")
+
+
+def behaviour(args):
+    return {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "hang_rate": args.hang_rate,
+        "hang_duration": args.hang_duration,
+        "missing_mac_rate": args.missing_mac_rate,
+        "legacy_firmware": args.legacy_firmware
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulates Palazzetti boxes on the local machine")
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="%(asctime)-15s %(levelname)-8s %(message)s")
+
+    simulator = Simulator(args.stoves, args.host, args.port, **behaviour(args))
+    simulator.start()
+    print("devices:")
+    for index, hostname in enumerate(simulator.hostnames()):
+        print("  - name: Simulated stove {}\n    hostname: {}".format(index, hostname))
+    while True:
+        time.sleep(3600)